@@ -3,9 +3,11 @@ import json
 import os
 import random
 import hashlib
+import hmac
 import pandas as pd
 import io
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, datetime
 import firebase_admin
 from firebase_admin import credentials, firestore
@@ -64,14 +66,14 @@ def safe_set(doc_ref, data, merge=True): return safe_db_op(doc_ref.set, data, me
 # ==========================================
 st.set_page_config(page_title="HighSchool Pro | 智能云端终端", page_icon="🧬", layout="wide")
 
-def inject_ui():
-    bg_url = "https://img.qianmo.de5.net/PicGo/ai-art-1766791555667.png"
-    st.markdown(f"""
+BG_URL = "https://img.qianmo.de5.net/PicGo/ai-art-1766791555667.png"
+# 样式只依赖常量，导入时拼装一次，避免每次 rerun 重新格式化
+UI_CSS = f"""
     <style>
     @import url('https://fonts.googleapis.com/css2?family=Space+Grotesk:wght@700&family=Noto+Sans+SC:wght@400;700&display=swap');
     :root {{ --gold: #D4AF37; --accent: #FF8C00; }}
     .stApp {{ 
-        background-image: linear-gradient(rgba(255,255,255,0.05), rgba(255,255,255,0.05)), url("{bg_url}"); 
+        background-image: linear-gradient(rgba(255,255,255,0.05), rgba(255,255,255,0.05)), url("{BG_URL}"); 
         background-size: cover; background-attachment: fixed; color: #1E293B; font-family: 'Noto Sans SC', sans-serif;
     }}
     section[data-testid="stSidebar"] {{ background: rgba(255,255,255,0.35) !important; backdrop-filter: blur(25px); border-right: 1px solid rgba(212,175,55,0.2); }}
@@ -82,59 +84,183 @@ def inject_ui():
     .stButton>button {{ border-radius: 12px; background: linear-gradient(135deg, #D4AF37, #B8860B) !important; color: white !important; font-weight: 700; border: none !important; }}
     .badge {{ display: inline-block; padding: 2px 10px; border-radius: 12px; background: rgba(212,175,55,0.12); color: #8B6B1B; font-size: 0.75rem; font-weight: 800; }}
     </style>
-    """, unsafe_allow_html=True)
+    """
+
+def inject_ui(): st.markdown(UI_CSS, unsafe_allow_html=True)
 
 # ==========================================
 # 3. 业务逻辑与数据管理
 # ==========================================
 SUBJECTS = {"chinese":"语文", "math":"数学", "english":"英语", "physics":"物理", "chemistry":"化学", "biology":"生物", "history":"历史", "geography":"地理", "politics":"政治"}
+PAGE_SIZE = 25 # 神经元复习每页渲染的考点数
 def get_user_path(uid): return f"artifacts/{APP_ID}/users/{uid}"
 def get_public_path(): return f"artifacts/{APP_ID}/public/data"
-def hash_pwd(p): return hashlib.sha256(p.encode()).hexdigest()
+def get_snapshot_path(uid): return f"{get_user_path(uid)}/snapshot/main"
+PWD_PREFIX = "blake2b$"
+def hash_pwd(p): return PWD_PREFIX + hashlib.blake2b(p.encode(), digest_size=32).hexdigest()
+def verify_pwd(p, stored):
+    """校验密钥；按前缀分派，兼容旧版无前缀的 sha256 哈希"""
+    if not stored: return False
+    cand = hash_pwd(p) if stored.startswith(PWD_PREFIX) else hashlib.sha256(p.encode()).hexdigest()
+    return hmac.compare_digest(cand, stored)
+
+def data_path(sid): return os.path.join("data", f"{sid}.json")
+def data_mtime(sid):
+    p = data_path(sid)
+    return os.path.getmtime(p) if os.path.exists(p) else 0
 
-def load_json(sid):
-    p = os.path.join("data", f"{sid}.json")
+def _read_json(sid):
+    p = data_path(sid)
     if os.path.exists(p):
         with open(p, "r", encoding="utf-8") as f: return json.load(f)
     return []
 
+@st.cache_data(show_spinner=False)
+def _load_json(sid, mtime):
+    """按 (学科, 文件修改时间) 缓存解析结果，文件被改写后 mtime 变化即自动失效"""
+    return _read_json(sid)
+
+def load_json(sid): return _load_json(sid, data_mtime(sid))
+
+@st.cache_data(show_spinner=False)
+def _subject_index(sid, mtime):
+    """神经元复习的过滤索引：(考点列表, 进度 key, 章节列表, 小写标题, 章节 -> 下标列表)"""
+    data = _load_json(sid, mtime)
+    by_chapter = {}
+    for idx, i in enumerate(data): by_chapter.setdefault(i.get("chapter", "未分类"), []).append(idx)
+    return data, [f"{sid}_{i['title']}" for i in data], sorted(by_chapter), [i["title"].lower() for i in data], by_chapter
+
+def subject_index(sid): return _subject_index(sid, data_mtime(sid))
+
+def _read_titles(sid):
+    """只保留标题列：正文/公式随解析中间对象一起释放，不进入缓存"""
+    p = data_path(sid)
+    if not os.path.exists(p): return ()
+    with open(p, "r", encoding="utf-8") as f: return tuple(i["title"] for i in json.load(f))
+
+@st.cache_data(show_spinner=False)
+def _load_all_titles(mtimes):
+    """并发读取全部学科的标题；mtimes 为各学科文件修改时间，任一文件变更即整体失效"""
+    with ThreadPoolExecutor(max_workers=len(SUBJECTS)) as ex:
+        return dict(zip(SUBJECTS, ex.map(_read_titles, SUBJECTS)))
+
+def load_all_titles(): return _load_all_titles(tuple(data_mtime(s) for s in SUBJECTS))
+
+@st.cache_data(show_spinner=False)
+def _subject_keyset(sid, mtime):
+    """学科全部考点的进度 key 集合，看板用集合交集统计掌握数"""
+    return frozenset(f"{sid}_{t}" for t in load_all_titles()[sid])
+
+def subject_keyset(sid): return _subject_keyset(sid, data_mtime(sid))
+
+def sample_points(k=10):
+    """跨学科蓄水池抽样 k 个考点：逐学科直接读文件 (不经缓存)，任一时刻只持有当前学科与 k 个样本"""
+    res, n = [], 0
+    for sid in SUBJECTS:
+        for i in _read_json(sid):
+            n += 1
+            if len(res) < k: res.append({**i, "sid": sid})
+            else:
+                j = random.randrange(n)
+                if j < k: res[j] = {**i, "sid": sid}
+    return res
+
 def save_json(sid, data):
     if not os.path.exists("data"): os.makedirs("data")
-    with open(os.path.join("data", f"{sid}.json"), "w", encoding="utf-8") as f:
+    with open(data_path(sid), "w", encoding="utf-8") as f:
         json.dump(data, f, ensure_ascii=False, indent=2)
 
-def sync_data(uid):
-    """同步用户所有掌握/难点进度"""
+PROGRESS_FIELDS = ["subject_id", "title", "is_mastered", "is_difficult"]
+CACHE_TTL = 300 # 云端读取在本地缓存的有效期 (秒)
+SYNC_RETRY = 60 # 云端读写失败后的退避间隔 (秒)：已有本地进度时的刷新、待写队列的提交
+BATCH_SIZE = 20 # 待写队列达到该长度即提交
+
+def sync_data(uid, force=False):
+    """同步用户所有掌握/难点进度 (缓存优先：TTL 内直接复用 session_state 中的结果)"""
+    if not force and time.time() - st.session_state.get("last_sync_ts", 0) < CACHE_TTL: return
+    flush_writes() # 先落盘本地待写，避免被云端旧快照覆盖
+    if st.session_state.get("pending_writes") and "mastered_points" in st.session_state:
+        # 待写仍未提交：本地集合已包含这些增量，刷新会让界面丢掉它们，推迟到队列清空后
+        st.session_state.last_sync_ts = time.time() - CACHE_TTL + SYNC_RETRY; return
     try:
         with st.status("🧬 正在同步云端神经网格...", expanded=False) as status:
-            # 增加 GCP 优化后的 stream 超时
-            docs = db.collection(f"{get_user_path(uid)}/progress").stream(timeout=45)
-            m, d = set(), set()
-            for doc in docs:
-                v = doc.to_dict()
-                key = f"{v['subject_id']}_{v['title']}"
-                if v.get("is_mastered") == 1: m.add(key)
-                if v.get("is_difficult") == 1: d.add(key)
+            snap_ref = db.document(get_snapshot_path(uid))
+            snap = safe_get(snap_ref)
+            if snap.exists:
+                v = snap.to_dict()
+                m, d = set(v.get("mastered", [])), set(v.get("difficult", []))
+            else:
+                # 老账号尚无快照：回退到逐条进度流 (投影查询只取 4 个字段)，并回写快照供下次单文档读取
+                docs = db.collection(f"{get_user_path(uid)}/progress").select(PROGRESS_FIELDS).stream(timeout=45)
+                rows = [doc.to_dict() for doc in docs]
+                m = {f"{v['subject_id']}_{v['title']}" for v in rows if v.get("is_mastered") == 1}
+                d = {f"{v['subject_id']}_{v['title']}" for v in rows if v.get("is_difficult") == 1}
+                safe_set(snap_ref, {"mastered": sorted(m), "difficult": sorted(d)})
             st.session_state.mastered_points, st.session_state.difficult_points = m, d
             st.session_state.data_synced = True
+            st.session_state.last_sync_ts = time.time()
             status.update(label="✅ 同步完成", state="complete")
     except Exception:
+        # 已有本地进度：继续使用旧数据，SYNC_RETRY 秒后再尝试刷新，避免每次 rerun 都阻塞在重试上
+        if "mastered_points" in st.session_state: st.session_state.last_sync_ts = time.time() - CACHE_TTL + SYNC_RETRY
         st.warning("⚠️ 网络拥塞，部分进度加载延迟。")
 
-def update_cloud(uid, sid, title, m=None, d=None):
+def flush_writes(force=False):
+    """把待写队列合并为一个 WriteBatch 提交 (一次 RPC)；网络类失败保留队列并退避 SYNC_RETRY 秒，永久性失败丢弃该批"""
+    pw = st.session_state.get("pending_writes")
+    if not pw or (not force and time.time() < st.session_state.get("next_flush_ts", 0)): return
+    batch = db.batch()
+    for path, data in pw: batch.set(db.document(path), data, merge=True)
     try:
-        did = hashlib.md5(f"{sid}_{title}".encode()).hexdigest()
-        ref = db.document(f"{get_user_path(uid)}/progress/{did}")
-        data = {"subject_id": sid, "title": title, "update_at": str(date.today())}
-        if m is not None: data["is_mastered"] = 1 if m else 0
-        if d is not None: data["is_difficult"] = 1 if d else 0
-        safe_set(ref, data)
-    except: pass
+        safe_db_op(batch.commit)
+        st.session_state.pending_writes = []
+    except (RetryError, ServiceUnavailable, DeadlineExceeded): st.session_state.next_flush_ts = time.time() + SYNC_RETRY
+    except Exception as e:
+        # 权限/参数等永久性错误重试无益：丢弃该批并提示，避免队列永远卡住
+        st.session_state.pending_writes = []
+        st.warning(f"⚠️ 部分进度被云端拒绝写入，已丢弃: {type(e).__name__}")
+
+def update_cloud(uid, sid, title, m=None, d=None):
+    """更新本地进度集合，并把 ArrayUnion/ArrayRemove 增量写入排入批量队列"""
+    key = f"{sid}_{title}"
+    data = {"update_at": str(date.today())}
+    if m is not None:
+        st.session_state.mastered_points.add(key) if m else st.session_state.mastered_points.discard(key)
+        data["mastered"] = firestore.ArrayUnion([key]) if m else firestore.ArrayRemove([key])
+    if d is not None:
+        st.session_state.difficult_points.add(key) if d else st.session_state.difficult_points.discard(key)
+        data["difficult"] = firestore.ArrayUnion([key]) if d else firestore.ArrayRemove([key])
+    pw = st.session_state.setdefault("pending_writes", [])
+    pw.append((get_snapshot_path(uid), data))
+    if len(pw) >= BATCH_SIZE: flush_writes()
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False)
+def get_global_stats():
+    """全网统计 (仅注册时变化)：进程级缓存 CACHE_TTL 秒，所有会话共享，新会话冷启动也无需读库"""
+    return safe_get(db.document(f"{get_public_path()}/stats/global")).to_dict() or {"user_count": 0}
 
 def speak(t):
     js = f"""<script>window.speechSynthesis.cancel(); var m=new SpeechSynthesisUtterance({json.dumps(t)}); m.lang='zh-CN'; window.speechSynthesis.speak(m);</script>"""
     components.html(js, height=0)
 
+@st.fragment
+def render_point(item, m_key, sid, uid):
+    """单个考点卡片；重点/掌握切换只重跑本片段，不触发整页 rerun"""
+    is_m, is_d = m_key in st.session_state.mastered_points, m_key in st.session_state.difficult_points
+    with st.expander(f"{'✅' if is_m else ('⭐' if is_d else '🧬')} {item['title']}"):
+        st.markdown(f"<span class='badge'>📚 {item.get('chapter','未分类')}</span>", unsafe_allow_html=True)
+        st.write(item['content'])
+        if item.get('formula'): st.latex(item['formula'])
+        st.write("")
+        ca, cb, cc = st.columns(3)
+        if ca.button("🔊 朗读", key=f"v_{m_key}"): speak(item['content'])
+        if cb.button("⭐ 重点" if not is_d else "🌟 取消", key=f"f_{m_key}"):
+            update_cloud(uid, sid, item['title'], d=not is_d); st.rerun(scope="fragment")
+        if cc.checkbox("掌握", key=f"m_{m_key}", value=is_m) != is_m:
+            update_cloud(uid, sid, item['title'], m=not is_m); st.rerun(scope="fragment")
+    # 片段重跑走不到脚本末尾的 flush：在切换后的这次片段运行结束时提交，保证进度随本次交互落盘
+    if st.session_state.get("pending_writes"): flush_writes()
+
 # ==========================================
 # 4. 身份认证 (V7.1 强力接入版专属)
 # ==========================================
@@ -142,6 +268,13 @@ if "logged_in" not in st.session_state: st.session_state.logged_in = False
 if "started" not in st.session_state: st.session_state.started = False
 if "data_synced" not in st.session_state: st.session_state.data_synced = False
 if "test_queue" not in st.session_state: st.session_state.test_queue = []
+# 登出时只清理与账号绑定的状态，其余会话级缓存保持温热
+USER_KEYS = ("logged_in", "started", "data_synced", "user_contact", "mastered_points", "difficult_points", "last_sync_ts",
+             "pending_writes", "next_flush_ts", "logout_blocked", "test_queue", "t_idx", "fl_idx")
+
+def logout():
+    for k in USER_KEYS: st.session_state.pop(k, None)
+    st.rerun()
 
 def auth_page():
     inject_ui()
@@ -171,10 +304,15 @@ def auth_page():
                     with st.status("📡 正在验证云端身份...") as status:
                         user_doc = safe_get(user_ref)
                         if user_doc.exists:
-                            if user_doc.to_dict().get("password") == hash_pwd(l_p):
+                            stored = user_doc.to_dict().get("password", "")
+                            if verify_pwd(l_p, stored):
+                                if not stored.startswith(PWD_PREFIX):
+                                    # 旧版 sha256 哈希：登录成功后就地升级为 blake2b
+                                    try: safe_set(user_ref, {"password": hash_pwd(l_p)})
+                                    except: pass
                                 st.session_state.logged_in, st.session_state.user_contact = True, l_u
                                 status.update(label="🔓 验证通过", state="running")
-                                sync_data(l_u); st.rerun()
+                                sync_data(l_u, force=True); st.rerun()
                             else: st.error("❌ 密钥错误")
                         else: st.error("❌ ID 不存在，请先注册或激活")
                 except PermissionDenied:
@@ -191,6 +329,7 @@ def auth_page():
                     else:
                         safe_set(user_ref, {"password": hash_pwd(r_p), "reg_date": str(date.today())})
                         db.document(f"{get_public_path()}/stats/global").set({"user_count": firestore.Increment(1)}, merge=True)
+                        get_global_stats.clear()
                         st.success("✅ 注册成功！请切换到登录页")
                 except: st.error("注册请求超时。")
         st.markdown('</div>', unsafe_allow_html=True)
@@ -207,53 +346,50 @@ elif not st.session_state.started:
     if c2.button("INITIALIZE LINK", use_container_width=True): st.session_state.started = True; st.rerun()
 else:
     inject_ui(); u = st.session_state.user_contact
-    if not st.session_state.data_synced: sync_data(u)
+    sync_data(u)
     
     with st.sidebar:
         st.markdown(f"<div style='padding:12px; border-radius:15px; background:rgba(212,175,55,0.15); text-align:center; color:#8B6B1B; font-weight:bold;'>👤 {u}</div>", unsafe_allow_html=True)
         mode = st.selectbox("功能指令", ["智脑看板", "神经元复习", "闪念卡片模式", "全科闯关挑战", "在线录入预览", "导出资料包", "安全设置"])
         st.divider()
         subject_id = st.selectbox("学科对照", list(SUBJECTS.keys()), format_func=lambda x: SUBJECTS[x])
+        if st.button("🔄 强制同步", use_container_width=True): sync_data(u, force=True); st.rerun()
         if st.button("LOGOUT (断开链路)", use_container_width=True):
-            st.session_state.clear(); st.rerun()
+            flush_writes(force=True)
+            # 队列仍在只可能是网络类失败：先拦下登出，由用户决定重试或放弃，避免进度被静默丢弃
+            if st.session_state.get("pending_writes"): st.session_state.logout_blocked = True
+            else: logout()
+        if st.session_state.get("logout_blocked") and st.session_state.get("pending_writes"):
+            st.warning("⚠️ 网络异常，仍有进度未同步至云端。可稍后重试登出，或放弃这些进度直接登出。")
+            if st.button("放弃未同步进度并登出", use_container_width=True): logout()
 
     # --- 模块：智脑看板 ---
     if mode == "智脑看板":
         st.title("📊 学习进度监控")
         try:
-            stats = db.document(f"{get_public_path()}/stats/global").get().to_dict() or {"user_count": 0}
+            stats = get_global_stats()
             c1, c2, c3 = st.columns(3)
             c1.metric("已掌握", len(st.session_state.mastered_points))
             c2.metric("高考倒计时", f"{(date(2026, 6, 7) - date.today()).days}D")
             c3.metric("网格总人数", stats.get("user_count", 0))
+            all_titles = load_all_titles()
             for sid, name in SUBJECTS.items():
-                d = load_json(sid); m = len([x for x in d if f"{sid}_{x['title']}" in st.session_state.mastered_points])
-                st.write(f"**{name}** ({m}/{len(d)})"); st.progress(m/len(d) if d else 0)
+                t = all_titles[sid]; m = len(subject_keyset(sid) & st.session_state.mastered_points)
+                st.write(f"**{name}** ({m}/{len(t)})"); st.progress(m/len(t) if t else 0)
         except: st.error("数据加载中...")
 
     # --- 模块：神经元复习 (核心功能) ---
     elif mode == "神经元复习":
         st.markdown(f"### {SUBJECTS[subject_id]} 系统")
-        data = load_json(subject_id)
-        chaps = sorted(list(set(i.get("chapter", "未分类") for i in data)))
+        data, keys, chaps, title_lc, by_chapter = subject_index(subject_id)
         sel_ch = st.selectbox("📚 章节过滤", ["全部"] + chaps)
         srch = st.text_input("🔍 搜索考点")
-        for item in data:
-            if (sel_ch != "全部" and item.get("chapter", "未分类") != sel_ch) or (srch and srch.lower() not in item['title'].lower()): continue
-            m_key = f"{subject_id}_{item['title']}"
-            is_m, is_d = m_key in st.session_state.mastered_points, m_key in st.session_state.difficult_points
-            with st.expander(f"{'✅' if is_m else ('⭐' if is_d else '🧬')} {item['title']}"):
-                st.markdown(f"<span class='badge'>📚 {item.get('chapter','未分类')}</span>", unsafe_allow_html=True)
-                st.write(item['content'])
-                if item.get('formula'): st.latex(item['formula'])
-                st.write("")
-                ca, cb, cc = st.columns(3)
-                if ca.button("🔊 朗读", key=f"v_{m_key}"): speak(item['content'])
-                if cb.button("⭐ 重点" if not is_d else "🌟 取消", key=f"f_{m_key}"):
-                    update_cloud(u, subject_id, item['title'], d=not is_d)
-                    st.session_state.difficult_points.add(m_key) if not is_d else st.session_state.difficult_points.discard(m_key); st.rerun()
-                if cc.checkbox("掌握", key=f"m_{m_key}", value=is_m):
-                    update_cloud(u, subject_id, item['title'], m=not is_m); st.rerun()
+        idx = range(len(data)) if sel_ch == "全部" else by_chapter.get(sel_ch, [])
+        if srch: q = srch.lower(); idx = [j for j in idx if q in title_lc[j]]
+        # 分页：每次只为当前页生成 expander 与按钮，组件数从 O(N) 降至 O(PAGE_SIZE)
+        pages = max(1, (len(idx) + PAGE_SIZE - 1) // PAGE_SIZE)
+        page = st.number_input(f"📄 页码 (共 {pages} 页 / {len(idx)} 个考点)", min_value=1, max_value=pages, value=1) if pages > 1 else 1
+        for j in idx[(page - 1) * PAGE_SIZE:page * PAGE_SIZE]: render_point(data[j], keys[j], subject_id, u)
 
     # --- 模块：闪念卡片 (补全逻辑) ---
     elif mode == "闪念卡片模式":
@@ -275,10 +411,7 @@ else:
         st.markdown("### 🏁 随机自测 (10题)")
         if not st.session_state.test_queue:
             if st.button("🚀 开始闯关"):
-                all_pts = []
-                for s in SUBJECTS.keys():
-                    for i in load_json(s): i['sid'] = s; all_pts.append(i)
-                st.session_state.test_queue = random.sample(all_pts, min(10, len(all_pts))); st.session_state.t_idx = 0; st.rerun()
+                st.session_state.test_queue = sample_points(10); st.session_state.t_idx = 0; st.rerun()
         elif st.session_state.t_idx < len(st.session_state.test_queue):
             it = st.session_state.test_queue[st.session_state.t_idx]
             st.write(f"第 {st.session_state.t_idx+1} 题")
@@ -307,8 +440,12 @@ else:
         st.title("📥 导出中心")
         sel = st.multiselect("选择学科", options=list(SUBJECTS.keys()), format_func=lambda x: SUBJECTS[x])
         if st.button("生成复习包"):
-            res = f"# 🎓 复习笔记 - {date.today()}\n\n"
+            buf = io.StringIO()
+            buf.write(f"# 🎓 复习笔记 - {date.today()}\n\n")
             for s in sel:
-                res += f"## 【{SUBJECTS[s]}】\n"
-                for i in load_json(s): res += f"### {i['title']}\n{i['content']}\n\n"
-            st.download_button("💾 点击下载", res, file_name="review.md")
\ No newline at end of file
+                buf.write(f"## 【{SUBJECTS[s]}】\n")
+                for i in load_json(s): buf.write(f"### {i['title']}\n{i['content']}\n\n")
+            st.download_button("💾 点击下载", buf.getvalue(), file_name="review.md")
+
+    # 整页运行结束时提交本轮累积的进度写入；片段内的多次切换在此合并为一次 RPC
+    flush_writes()
\ No newline at end of file